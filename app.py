@@ -1,18 +1,31 @@
 import streamlit as st
 from openai import OpenAI
-import PyPDF2
-import pdfplumber
 import io
+import re
+import os
+import hashlib
+import base64
 import json
 import gzip
+import zlib
+import codecs
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from docx import Document
-from pptx import Presentation
-import openpyxl
-from striprtf.striprtf import rtf_to_text
-from bs4 import BeautifulSoup
-import ebooklib
-from ebooklib import epub
+from html import escape as html_escape, unescape as html_unescape
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:
+    detect_charset = None
+
+logger = logging.getLogger(__name__)
 
 st.set_page_config(
     page_title="Universal Document Q&A",
@@ -23,122 +36,476 @@ st.set_page_config(
 # Initialize OpenAI client
 @st.cache_resource
 def get_client():
-    import os
     try:
         api_key = st.secrets.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
         if api_key:
             return OpenAI(api_key=api_key)
-    except:
+    except Exception:
         pass
     return None
 
 client = get_client()
 
+# Extraction cache
+class ExtractionCache:
+    """Persistent extraction results keyed by a BLAKE2b digest of the file bytes"""
+    
+    def __init__(self, path, max_entries=64):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.dirty = False
+        # One instance is shared by every session's script thread
+        self.lock = threading.Lock()
+        # Single worker so writes land in submission order
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.entries = orjson.loads(data) if orjson else json.loads(data)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Ignoring unreadable extraction cache %s", path)
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Re-insert so dict order tracks recency for eviction
+                self.entries[key] = entry
+            return entry
+    
+    def put(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            self.dirty = True
+    
+    def save(self):
+        """Write the cache to disk in the background"""
+        with self.lock:
+            if not self.dirty:
+                return None
+            self.dirty = False
+            snapshot = dict(self.entries)
+        return self.writer.submit(self._write, snapshot)
+    
+    def _write(self, entries):
+        # Serialize up front and write in one call, then swap the file in with
+        # os.replace so readers never see a half-written cache
+        tmp_path = self.path + ".tmp"
+        try:
+            data = orjson.dumps(entries) if orjson else json.dumps(entries).encode('utf-8')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logger.exception("Could not write extraction cache %s", self.path)
+
+@st.cache_resource
+def get_cache():
+    return ExtractionCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".extraction_cache.json"))
+
+cache = get_cache()
+
 # Document extraction functions
+# Format libraries are imported inside each extractor so a session only pays
+# for the parsers its uploads actually need
+def has_real_text(text, threshold=50, limit=4096):
+    """Check that extracted text has more than `threshold` non-whitespace characters"""
+    # Count within the first `limit` characters instead of the whole (possibly
+    # multi-MB) string; str.split drops the same Unicode whitespace as strip()
+    if len("".join(text[:limit].split())) > threshold:
+        return True
+    if len(text) <= limit:
+        return False
+    return len("".join(text.split())) > threshold
+
+def join_page_texts(pages, extract, probe=3):
+    """Join per-page text, giving up if the first `probe` pages have none"""
+    # Only the slow pure-Python tier uses this: a PDF with no text on its
+    # first pages is almost always scanned, so skip parsing the rest
+    texts = []
+    for i, page in enumerate(pages, 1):
+        texts.append(extract(page) or "")
+        if i == probe and not any(t.strip() for t in texts):
+            return ""
+    return "\n\n".join(texts)
+
+# PDFium and MuPDF are not thread-safe, even across separate documents, and
+# uploads (and sessions) are extracted on parallel threads
+PDFIUM_LOCK = threading.Lock()
+MUPDF_LOCK = threading.Lock()
+
+def pdfium_text(file_bytes):
+    """Extract the text layer of every page with PDFium"""
+    import pypdfium2 as pdfium
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            return "\n\n".join(page.get_textpage().get_text_range() for page in pdf)
+        finally:
+            pdf.close()
+
+STARTXREF_RE = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+XREF_TARGET_RE = re.compile(rb'\s*(?:xref|\d+\s+\d+\s+obj)')
+
+def needs_repair(file_bytes):
+    """Check the header and trailer to see whether pikepdf could help"""
+    # Without a PDF header there is nothing for qpdf to rebuild
+    if b'%PDF-' not in file_bytes[:1024]:
+        return False
+    offsets = STARTXREF_RE.findall(file_bytes[-1024:])
+    if not offsets:
+        return True
+    # An intact trailer points at an xref table or an xref stream object
+    offset = int(offsets[-1])
+    return XREF_TARGET_RE.match(file_bytes, offset, offset + 64) is None
+
 def extract_pdf(file_bytes):
     """Extract text from PDF"""
-    # Try pdfplumber first
+    # Set once a native backend reads the file without error; the pure-Python
+    # tiers only help with files those backends cannot parse
+    parsed = False
+    
+    # Try pypdfium2 first (C-backed, fastest)
     try:
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            text = "\n\n".join([page.extract_text() or "" for page in pdf.pages])
-            if len(text.strip()) > 50:
-                return text
-    except:
-        pass
+        text = pdfium_text(file_bytes)
+        parsed = True
+        if has_real_text(text):
+            return text
+    except Exception:
+        logger.debug("pypdfium2 could not read PDF", exc_info=True)
     
-    # Try PyPDF2
+    # Try PyMuPDF
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-        text = "\n\n".join([page.extract_text() or "" for page in pdf_reader.pages])
-        if len(text.strip()) > 50:
+        import pymupdf
+        with MUPDF_LOCK, pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+            # No backend can read an encrypted file without the password
+            if doc.needs_pass:
+                return "Could not extract text from PDF: the file is password-protected"
+            # Plain "text" mode skips the block/span layout dicts
+            text = "\n\n".join(page.get_text("text") for page in doc)
+        parsed = True
+        if has_real_text(text):
             return text
-    except:
-        pass
+    except Exception:
+        logger.debug("PyMuPDF could not read PDF", exc_info=True)
+    
+    if parsed:
+        # The file is readable but has no text layer, e.g. a scanned document
+        return "Could not extract text from PDF: no text layer found"
+    
+    # Let qpdf rebuild a damaged structure, then retry PDFium on the repaired copy
+    if needs_repair(file_bytes):
+        try:
+            import pikepdf
+            repaired = io.BytesIO()
+            with pikepdf.open(io.BytesIO(file_bytes)) as pdf:
+                pdf.save(repaired)
+            text = pdfium_text(repaired.getvalue())
+            if has_real_text(text):
+                return text
+        except Exception:
+            logger.debug("pikepdf could not repair PDF", exc_info=True)
+    
+    # Fall back to pdfplumber
+    try:
+        import pdfplumber
+        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+            text = join_page_texts(pdf.pages, lambda page: page.extract_text())
+            if has_real_text(text):
+                return text
+    except Exception:
+        logger.debug("pdfplumber could not read PDF", exc_info=True)
     
     return "Could not extract text from PDF"
 
 def extract_docx(file_bytes):
     """Extract text from DOCX"""
-    doc = Document(io.BytesIO(file_bytes))
-    return "\n\n".join([para.text for para in doc.paragraphs if para.text.strip()])
+    # Read word/document.xml directly rather than building python-docx's
+    # Paragraph/Run objects for every <w:p>
+    import zipfile
+    from lxml import etree
+    parser = etree.XMLParser(resolve_entities=False)
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as archive:
+        # The main part is whatever the package's officeDocument relationship
+        # targets; some saves name it word/document2.xml
+        main_part = 'word/document.xml'
+        if '_rels/.rels' in archive.namelist():
+            rels = etree.fromstring(archive.read('_rels/.rels'), parser)
+            rel_tag = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+            for rel in rels.iterfind(rel_tag):
+                if rel.get('Type', '').endswith('/officeDocument') and rel.get('TargetMode') != 'External':
+                    main_part = rel.get('Target', main_part).lstrip('/')
+                    break
+        xml = archive.read(main_part)
+    root = etree.fromstring(xml, parser)
+    w = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+    ns = {'w': w}
+    # Body-level paragraphs only, matching python-docx's Document.paragraphs
+    body_paragraphs = etree.XPath('/w:document/w:body/w:p', namespaces=ns)
+    # Same run content python-docx reads: direct children of the paragraph's
+    # own runs, so text boxes nested in drawings/mc:AlternateContent are skipped
+    run_content = etree.XPath(
+        '(w:r | w:hyperlink/w:r)/*[self::w:t or self::w:tab or self::w:ptab'
+        ' or self::w:br or self::w:cr or self::w:noBreakHyphen]',
+        namespaces=ns
+    )
+    text_tag = f'{{{w}}}t'
+    br_tag = f'{{{w}}}br'
+    br_type = f'{{{w}}}type'
+    symbols = {f'{{{w}}}tab': '\t', f'{{{w}}}ptab': '\t', f'{{{w}}}cr': '\n', f'{{{w}}}noBreakHyphen': '-'}
+    
+    def element_text(el):
+        if el.tag == text_tag:
+            return el.text or ""
+        if el.tag == br_tag:
+            # Page and column breaks have no plain-text equivalent
+            return "\n" if el.get(br_type, 'textWrapping') == 'textWrapping' else ""
+        return symbols[el.tag]
+    
+    def paragraph_texts():
+        for para in body_paragraphs(root):
+            t = "".join(map(element_text, run_content(para)))
+            if t and not t.isspace():
+                yield t
+    
+    return "\n\n".join(paragraph_texts())
 
 def extract_pptx(file_bytes):
     """Extract text from PPTX"""
+    from pptx import Presentation
     prs = Presentation(io.BytesIO(file_bytes))
-    text = []
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text.append(shape.text)
-    return "\n\n".join(text)
+    
+    def shape_texts():
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if shape.has_text_frame:
+                    yield shape.text_frame.text
+                elif shape.has_table:
+                    for row in shape.table.rows:
+                        yield " | ".join(cell.text for cell in row.cells)
+    
+    return "\n\n".join(shape_texts())
 
 def extract_xlsx(file_bytes):
     """Extract text from XLSX"""
-    wb = openpyxl.load_workbook(io.BytesIO(file_bytes))
+    import openpyxl
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
     text = []
-    for sheet in wb.worksheets:
-        text.append(f"Sheet: {sheet.title}")
-        for row in sheet.iter_rows(values_only=True):
-            row_text = " | ".join([str(cell) if cell is not None else "" for cell in row])
-            if row_text.strip():
-                text.append(row_text)
+    try:
+        for sheet in wb.worksheets:
+            text.append(f"Sheet: {sheet.title}")
+            for row in sheet.iter_rows(values_only=True):
+                if any(cell is not None for cell in row):
+                    # Same " | " cell separator as PPTX table rows
+                    text.append(" | ".join("" if cell is None else str(cell) for cell in row))
+    finally:
+        # Read-only workbooks keep the archive open until closed
+        wb.close()
     return "\n".join(text)
 
+def extract_html(markup):
+    """Extract visible text from HTML"""
+    # Fragments without any tags (common for EPUB filler items) need no parse
+    if b'<' not in markup:
+        return html_unescape(markup.decode('utf-8', errors='ignore')).strip()
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(markup, 'lxml')
+    for tag in soup(['script', 'style', 'noscript']):
+        tag.decompose()
+    return soup.get_text(separator="\n", strip=True)
+
+def extract_epub(file_bytes):
+    """Extract text from EPUB"""
+    import ebooklib
+    from ebooklib import epub
+    book = epub.read_epub(io.BytesIO(file_bytes))
+    # Whitespace-only items carry no text, so don't hand them to the parser
+    contents = [content for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)
+                if (content := item.get_content()).strip()]
+    if not contents:
+        return ""
+    # Chapters are independent; map() keeps them in spine order
+    with ThreadPoolExecutor(max_workers=min(8, len(contents))) as executor:
+        # Cover and separator pages parse to "" and would leave blank gaps
+        return "\n\n".join(text for text in executor.map(extract_html, contents) if text)
+
+def extract_gz(file_bytes):
+    """Extract text from a gzip-compressed file"""
+    # Decompress and decode in 1 MiB chunks so the full decompressed bytes are never held at once
+    try:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        chunks = []
+        with gzip.GzipFile(fileobj=io.BytesIO(file_bytes)) as gz:
+            while True:
+                block = gz.read(1 << 20)
+                if not block:
+                    break
+                chunks.append(decoder.decode(block))
+        chunks.append(decoder.decode(b"", final=True))
+        return "".join(chunks)
+    except (OSError, EOFError, zlib.error):
+        return "Error: Unable to decompress .gz file"
+
+def extract_rtf(file_bytes):
+    """Extract text from RTF"""
+    from striprtf.striprtf import rtf_to_text
+    # RTF is 7-bit ASCII with \'xx / \u escapes that striprtf decodes itself,
+    # so a 1:1 latin-1 byte view is enough and skips UTF-8 validation
+    return rtf_to_text(file_bytes.decode('latin-1'))
+
+def decode_text(file_bytes):
+    """Decode plain-text formats"""
+    try:
+        return file_bytes.decode('utf-8')
+    except UnicodeDecodeError as e:
+        bad = e.start
+    # Valid multi-byte sequences make the text shorter than the bytes; when
+    # they outnumber the bad bytes this is UTF-8 with a few stray bytes, not a
+    # legacy encoding, and a detector would only guess wrong
+    text = file_bytes.decode('utf-8', errors='replace')
+    if len(file_bytes) - len(text) > text.count('\ufffd'):
+        return text
+    # Guess the legacy encoding from 64 KiB around the first invalid byte,
+    # since a clean prefix (often pure ASCII) says nothing about the rest
+    if detect_charset is not None:
+        match = detect_charset(file_bytes[max(0, bad - 32768):bad + 32768]).best()
+        # ASCII can't be right once a byte failed to decode as UTF-8
+        if match is not None and match.encoding != 'ascii':
+            try:
+                return file_bytes.decode(match.encoding, errors='replace')
+            except LookupError:
+                pass
+    return file_bytes.decode('utf-8', errors='ignore')
+
+# Extension -> extractor; extract_text decodes any other extension as plain text
+EXTRACTORS = {
+    'pdf': extract_pdf,
+    'docx': extract_docx,
+    'doc': extract_docx,
+    'pptx': extract_pptx,
+    'ppt': extract_pptx,
+    'xlsx': extract_xlsx,
+    'xls': extract_xlsx,
+    'txt': decode_text,
+    'csv': decode_text,
+    'md': decode_text,
+    'py': decode_text,
+    'json': decode_text,
+    'env': decode_text,
+    'sh': decode_text,
+    'gz': extract_gz,
+    'rtf': extract_rtf,
+    'html': extract_html,
+    'htm': extract_html,
+    'epub': extract_epub,
+}
+
+# Prefixes of the messages extractors return in place of text
+EXTRACTION_FAILURES = ("Error extracting text:", "Could not extract text", "Error: Unable to")
+
+def extraction_failed(text):
+    """Check whether extracted text is actually an extractor's failure message"""
+    return text.startswith(EXTRACTION_FAILURES)
+
 def extract_text(file_bytes, filename):
     """Universal text extraction"""
     ext = filename.lower().split('.')[-1]
+    handler = EXTRACTORS.get(ext, decode_text)
     
     try:
-        if ext == 'pdf':
-            return extract_pdf(file_bytes)
-        elif ext in ['docx', 'doc']:
-            return extract_docx(file_bytes)
-        elif ext in ['pptx', 'ppt']:
-            return extract_pptx(file_bytes)
-        elif ext in ['xlsx', 'xls']:
-            return extract_xlsx(file_bytes)
-        elif ext == 'txt':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'csv':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'md':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'py':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'json':
-            try:
-                json_data = json.loads(file_bytes.decode('utf-8'))
-                return json.dumps(json_data, indent=2)
-            except:
-                return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'env':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'sh':
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'gz':
-            try:
-                decompressed = gzip.decompress(file_bytes)
-                return decompressed.decode('utf-8', errors='ignore')
-            except:
-                return "Error: Unable to decompress .gz file"
-        elif ext == 'rtf':
-            return rtf_to_text(file_bytes.decode('utf-8', errors='ignore'))
-        elif ext in ['html', 'htm']:
-            soup = BeautifulSoup(file_bytes, 'html.parser')
-            return soup.get_text()
-        elif ext == 'epub':
-            book = epub.read_epub(io.BytesIO(file_bytes))
-            text = []
-            for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text.append(soup.get_text())
-            return "\n\n".join(text)
-        else:
-            return file_bytes.decode('utf-8', errors='ignore')
+        return handler(file_bytes)
     except Exception as e:
+        logger.exception("Extraction failed for %s", filename)
         return f"Error extracting text: {str(e)}"
 
+# Text cleanup
+# C0 control characters other than tab, newline and carriage return
+_CONTROL_CHARS = dict.fromkeys(c for c in range(0x20) if c not in (0x09, 0x0A, 0x0D))
+_CONTROL_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]+')
+
+def clean_text(text):
+    """Strip NULs and stray control characters left behind by extractors"""
+    # str.translate has a fast path for ASCII strings; the regex is faster otherwise
+    if text.isascii():
+        return text.translate(_CONTROL_CHARS)
+    return _CONTROL_CHARS_RE.sub('', text)
+
+# orjson parses integers outside the 64-bit range as floats; json keeps them exact
+_BIG_INT_RE = re.compile(r'\d{19}')
+
+def prettify_json(text):
+    """Re-indent JSON text, returning it unchanged if it does not parse"""
+    try:
+        if orjson is not None and not _BIG_INT_RE.search(text):
+            return orjson.dumps(orjson.loads(text), option=orjson.OPT_INDENT_2).decode('utf-8')
+        return json.dumps(json.loads(text), indent=2)
+    except (ValueError, TypeError, RecursionError):
+        # Unparseable, or nested deeper than orjson (TypeError) or the
+        # interpreter's recursion limit allows
+        return text
+
+def extract_document(file_bytes, filename, pretty_json=False):
+    """Extract and clean the text of one uploaded file"""
+    text = clean_text(extract_text(file_bytes, filename))
+    if pretty_json:
+        text = prettify_json(text)
+    return text
+
+# Bump whenever an extractor's output changes, so text cached by an older
+# version is extracted again instead of being served from the cache
+EXTRACTION_VERSION = 2
+
+def extraction_key(file_bytes, filename, pretty_json=False):
+    """Cache key identifying the extracted text of one uploaded file"""
+    # The same bytes extract differently per format (an .html upload is
+    # stripped of markup, a .txt copy is not), so the extractor is part of it
+    ext = filename.lower().split('.')[-1]
+    extractor = EXTRACTORS.get(ext, decode_text).__name__
+    digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    return f"v{EXTRACTION_VERSION}:{extractor}:{digest}" + (":pretty" if pretty_json else "")
+
+def document_entry(text, size, processed_at, key):
+    """Build the session record for a processed document"""
+    # Text is held zlib-compressed (typically 3-5x smaller) since it is only
+    # needed again when an export is built; derived display fields are
+    # computed once here instead of on every rerun
+    return {
+        'text_z': zlib.compress(text.encode('utf-8'), 1),
+        'size': size,
+        'processed_at': processed_at,
+        'key': key,
+        'char_count': len(text),
+        'preview': text[:500] + "..." if len(text) > 500 else text
+    }
+
+def document_text(doc):
+    """Return the full text of a session document record"""
+    return zlib.decompress(doc['text_z']).decode('utf-8')
+
+def cache_record(doc):
+    """Build the extraction cache entry for a session document record"""
+    # Same compressed text as the session holds, base64-encoded for JSON
+    record = {field: doc[field] for field in ('size', 'processed_at', 'char_count', 'preview')}
+    record['text_z'] = base64.b64encode(doc['text_z']).decode('ascii')
+    return record
+
+def cached_document(record, key):
+    """Rebuild a session document record from an extraction cache entry"""
+    return {**record, 'text_z': base64.b64decode(record['text_z']), 'key': key}
+
 # Export functions
+def dump_json(data):
+    """Serialize to indented UTF-8 JSON, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode('utf-8')
+
 def export_txt(text, filename):
     return text.encode('utf-8')
 
@@ -149,14 +516,15 @@ def export_json(text, filename):
         "text": text,
         "character_count": len(text)
     }
-    return json.dumps(data, indent=2).encode('utf-8')
+    return dump_json(data)
 
 def export_html(text, filename):
-    html = f"""<!DOCTYPE html>
+    title = html_escape(filename)
+    header = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <title>{filename}</title>
+    <title>{title}</title>
     <style>
         body {{ font-family: Arial, sans-serif; max-width: 800px; margin: 50px auto; padding: 20px; }}
         h1 {{ color: #333; }}
@@ -164,11 +532,59 @@ def export_html(text, filename):
     </style>
 </head>
 <body>
-    <h1>{filename}</h1>
-    <pre>{text}</pre>
+    <h1>{title}</h1>
+    <pre>"""
+    footer = """</pre>
 </body>
 </html>"""
-    return html.encode('utf-8')
+    # Encode the parts separately so the full document is never built as one str
+    return b"".join((
+        header.encode('utf-8'),
+        html_escape(text, quote=False).encode('utf-8'),
+        footer.encode('utf-8')
+    ))
+
+# Per-document exports are keyed on the document's cache key; _doc is not hashed.
+# Each entry holds three uncompressed payloads shared across sessions, so keep
+# only the recently viewed documents and let idle ones expire
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def build_exports(filename, key, _doc):
+    """Build the TXT, JSON and HTML exports for one document"""
+    text = document_text(_doc)
+    return (
+        export_txt(text, filename),
+        export_json(text, filename),
+        export_html(text, filename)
+    )
+
+# Only rebuilt when the set of documents changes; _documents is not hashed,
+# so doc_keys must identify its contents
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def build_bulk_exports(doc_keys, _documents):
+    """Build the combined TXT, JSON and HTML exports"""
+    texts = {name: document_text(doc) for name, doc in _documents.items()}
+    all_text = "\n\n==========\n\n".join(
+        f"FILE: {name}\n\n{text}"
+        for name, text in texts.items()
+    )
+    bulk_json = dump_json({
+        "exported_at": datetime.now().isoformat(),
+        "document_count": len(_documents),
+        "documents": [
+            {
+                "filename": name,
+                "text": texts[name],
+                "size": doc['size'],
+                "processed_at": doc['processed_at']
+            }
+            for name, doc in _documents.items()
+        ]
+    })
+    return (
+        export_txt(all_text, "all_documents"),
+        bulk_json,
+        export_html(all_text, "all_documents")
+    )
 
 # Main UI
 st.title("📄 Universal Document Q&A System")
@@ -185,7 +601,11 @@ st.markdown("""
 uploaded_files = st.file_uploader(
     "Upload your documents",
     accept_multiple_files=True,
-    type=['pdf', 'docx', 'doc', 'pptx', 'ppt', 'xlsx', 'xls', 'txt', 'csv', 'md', 'rtf', 'html', 'htm', 'epub']
+    type=['pdf', 'docx', 'doc', 'pptx', 'ppt', 'xlsx', 'xls', 'txt', 'csv', 'md', 'json', 'rtf', 'html', 'htm', 'epub']
+)
+pretty_json = st.checkbox(
+    "Pretty-print JSON",
+    help="Re-indent uploaded JSON files. Off by default since large files are much faster to keep as-is."
 )
 
 if uploaded_files:
@@ -193,92 +613,112 @@ if uploaded_files:
     if 'documents' not in st.session_state:
         st.session_state.documents = {}
     
+    # Forget documents whose files were removed from the uploader, so session
+    # memory tracks the current upload set; a re-upload is an extraction cache hit
+    current_names = {uploaded_file.name for uploaded_file in uploaded_files}
+    for name in [name for name in st.session_state.documents if name not in current_names]:
+        del st.session_state.documents[name]
+    
     # Process files
+    # UploadedFile is not thread-safe, so read bytes here and hand them to the workers
+    pending = {}
     for uploaded_file in uploaded_files:
-        if uploaded_file.name not in st.session_state.documents:
-            with st.spinner(f"Processing {uploaded_file.name}..."):
-                file_bytes = uploaded_file.read()
-                text = extract_text(file_bytes, uploaded_file.name)
-                st.session_state.documents[uploaded_file.name] = {
-                    'text': text,
-                    'size': len(file_bytes),
-                    'processed_at': datetime.now().isoformat()
+        pretty = pretty_json and uploaded_file.name.lower().endswith('.json')
+        doc = st.session_state.documents.get(uploaded_file.name)
+        # Reprocess when the pretty-print option changed since the file was extracted
+        if doc is not None and doc['key'].endswith(":pretty") == pretty:
+            continue
+        file_bytes = uploaded_file.getvalue()
+        key = extraction_key(file_bytes, uploaded_file.name, pretty)
+        cached = cache.get(key)
+        if cached:
+            st.session_state.documents[uploaded_file.name] = cached_document(cached, key)
+        else:
+            pending[uploaded_file.name] = (file_bytes, key, pretty)
+    if pending:
+        with st.spinner(f"Processing {len(pending)} document(s)..."):
+            progress = st.progress(0.0)
+            with ThreadPoolExecutor(max_workers=min(8, len(pending))) as executor:
+                futures = {
+                    executor.submit(extract_document, file_bytes, name, pretty): name
+                    for name, (file_bytes, key, pretty) in pending.items()
                 }
+                for done, future in enumerate(as_completed(futures), start=1):
+                    name = futures[future]
+                    file_bytes, key, pretty = pending[name]
+                    text = future.result()
+                    doc = document_entry(text, len(file_bytes), datetime.now().isoformat(), key)
+                    # Failures may be transient (a missing library, MemoryError),
+                    # so only successful extractions are kept for future uploads
+                    if not extraction_failed(text):
+                        cache.put(key, cache_record(doc))
+                    st.session_state.documents[name] = doc
+                    progress.progress(done / len(futures), text=f"Processed {name}")
+            progress.empty()
+        cache.save()
     
     # Display processed documents
     st.success(f"✅ {len(st.session_state.documents)} document(s) processed")
     
     # Show document list
     with st.expander("📋 View Processed Documents"):
-        for name, doc in st.session_state.documents.items():
-            st.write(f"**{name}**")
-            st.write(f"- Characters: {len(doc['text']):,}")
-            st.write(f"- Size: {doc['size']:,} bytes")
-            
-            # Preview
-            preview = doc['text'][:500] + "..." if len(doc['text']) > 500 else doc['text']
-            st.text_area(f"Preview of {name}", preview, height=100, key=f"preview_{name}")
-            
-            # Export buttons
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.download_button(
-                    "💾 Download TXT",
-                    export_txt(doc['text'], name),
-                    f"{name}.txt",
-                    "text/plain",
-                    key=f"txt_{name}"
-                )
-            with col2:
-                st.download_button(
-                    "📦 Download JSON",
-                    export_json(doc['text'], name),
-                    f"{name}.json",
-                    "application/json",
-                    key=f"json_{name}"
-                )
-            with col3:
-                st.download_button(
-                    "🌐 Download HTML",
-                    export_html(doc['text'], name),
-                    f"{name}.html",
-                    "text/html",
-                    key=f"html_{name}"
-                )
-            st.divider()
+        # Render one document at a time; every download button ships its
+        # payload to the browser on each rerun, so listing all of them is O(N)
+        name = st.selectbox("Document", list(st.session_state.documents), key="selected_document")
+        doc = st.session_state.documents[name]
+        st.write(f"**{name}**")
+        st.write(f"- Characters: {doc['char_count']:,}")
+        st.write(f"- Size: {doc['size']:,} bytes")
+        
+        # Preview (read-only element, no widget state to sync on each rerun)
+        st.code(doc['preview'], language=None)
+        
+        # Export buttons
+        doc_txt, doc_json, doc_html = build_exports(name, doc['key'], doc)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.download_button(
+                "💾 Download TXT",
+                doc_txt,
+                f"{name}.txt",
+                "text/plain",
+                key=f"txt_{name}"
+            )
+        with col2:
+            st.download_button(
+                "📦 Download JSON",
+                doc_json,
+                f"{name}.json",
+                "application/json",
+                key=f"json_{name}"
+            )
+        with col3:
+            st.download_button(
+                "🌐 Download HTML",
+                doc_html,
+                f"{name}.html",
+                "text/html",
+                key=f"html_{name}"
+            )
     
     # Bulk Export Section
     st.header("📦 Bulk Export All Documents")
     
-    # Combine all documents
-    all_text = "\n\n==========\n\n".join([
-        f"FILE: {name}\n\n{doc['text']}"
-        for name, doc in st.session_state.documents.items()
-    ])
+    bulk_txt, bulk_json, bulk_html = build_bulk_exports(
+        tuple((name, doc['key']) for name, doc in st.session_state.documents.items()),
+        st.session_state.documents
+    )
     
     col1, col2, col3 = st.columns(3)
     with col1:
         st.download_button(
             "📝 Download All as TXT",
-            export_txt(all_text, "all_documents"),
+            bulk_txt,
             "all_documents.txt",
             "text/plain",
             key="bulk_txt"
         )
     with col2:
-        bulk_json = json.dumps({
-            "exported_at": datetime.now().isoformat(),
-            "document_count": len(st.session_state.documents),
-            "documents": [
-                {
-                    "filename": name,
-                    "text": doc['text'],
-                    "size": doc['size'],
-                    "processed_at": doc['processed_at']
-                }
-                for name, doc in st.session_state.documents.items()
-            ]
-        }, indent=2).encode('utf-8')
         st.download_button(
             "📦 Download All as JSON",
             bulk_json,
@@ -289,13 +729,14 @@ if uploaded_files:
     with col3:
         st.download_button(
             "🌐 Download All as HTML",
-            export_html(all_text, "all_documents"),
+            bulk_html,
             "all_documents.html",
             "text/html",
             key="bulk_html"
         )
 
 else:
+    st.session_state.pop('documents', None)
     st.info("👆 Upload documents to get started")
 
 # Footer